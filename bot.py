@@ -2,20 +2,35 @@
 CrossyPosty — Telegram bot for cross-posting videos to YouTube, TikTok, Instagram, VK
 """
 import os
+import re
 import sys
 import json
 import asyncio
 import logging
+import time
 import uuid
+import functools
+import concurrent.futures
 from pathlib import Path
+from collections import Counter
+from dataclasses import dataclass
 from datetime import datetime
 
+import aiofiles
+import aiofiles.os
+import aiohttp
+import diskcache
 from dotenv import load_dotenv
-from aiogram import Bot, Dispatcher, Router, F
+from aiogram import Bot, Dispatcher, Router, F, BaseMiddleware
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.methods import GetUpdates
+from aiolimiter import AsyncLimiter
 from aiogram.types import (
     Message, CallbackQuery, InlineKeyboardButton, InlineKeyboardMarkup,
     FSInputFile, BotCommand
 )
+from aiogram.dispatcher.flags import get_flag
 from aiogram.filters import CommandStart, Command
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
@@ -28,40 +43,98 @@ logger = logging.getLogger(__name__)
 
 # --- Config ---
 BOT_TOKEN = os.getenv("BOT_TOKEN", "")
+PUBLISH_WORKERS = int(os.getenv("PUBLISH_WORKERS", "2"))
+UPLOAD_WORKERS = int(os.getenv("UPLOAD_WORKERS", "8"))
+REDIS_URL = os.getenv("REDIS_URL", "")
 ADMIN_IDS = [int(x.strip()) for x in os.getenv("ADMIN_IDS", "").split(",") if x.strip()]
 DOWNLOAD_DIR = Path("downloads")
 DOWNLOAD_DIR.mkdir(exist_ok=True)
+DOWNLOAD_CACHE_BYTES = int(os.getenv("DOWNLOAD_CACHE_MB", "2048")) * 1024 * 1024
 DATA_DIR = Path("data")
 DATA_DIR.mkdir(exist_ok=True)
 TOKENS_FILE = DATA_DIR / "tokens.json"
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DOWNLOAD_TIMEOUT = 300
+STATUS_EDIT_INTERVAL = 1.5
+
+_VK_TOKEN_RE = re.compile(r"access_token=([^&]+)")
 
 # --- Token storage ---
-def load_tokens():
-    if TOKENS_FILE.exists():
-        return json.loads(TOKENS_FILE.read_text())
-    return {}
+# SQLite-backed, one entry per user: str(user_id) -> {platform: token_data}
+token_store = diskcache.Cache(str(DATA_DIR / "tokens"))
+
+def _migrate_legacy_tokens():
+    # One-time import of the old tokens.json into the cache. Several instances
+    # may start at once; whoever loses the race finds the file already moved
+    try:
+        data = json.loads(TOKENS_FILE.read_text())
+    except FileNotFoundError:
+        return
+    with token_store.transact():
+        for uid, user_tokens in data.items():
+            token_store.add(uid, user_tokens)
+    # Retire the file atomically so removed tokens can't be re-imported later
+    try:
+        os.replace(TOKENS_FILE, TOKENS_FILE.with_suffix(".json.migrated"))
+    except FileNotFoundError:
+        return
+    logger.info(f"Migrated tokens of {len(data)} users from {TOKENS_FILE}")
 
-def save_tokens(data):
-    TOKENS_FILE.write_text(json.dumps(data, indent=2, ensure_ascii=False))
+_migrate_legacy_tokens()
 
-def get_user_tokens(user_id):
-    data = load_tokens()
-    return data.get(str(user_id), {})
+# In-process copy of token_store, keyed by int user_id. Disabled when REDIS_URL
+# is set: other bot processes may change tokens and nothing invalidates it.
+# token_store itself is a local SQLite directory, so Redis mode only shares
+# tokens between processes on the same host and filesystem
+_TOKEN_CACHE: dict[int, dict] = {}
 
-def set_user_token(user_id, platform, token_data):
-    data = load_tokens()
+def load_all_tokens():
+    for uid in token_store.iterkeys():
+        _TOKEN_CACHE[int(uid)] = token_store.get(uid, {})
+
+def _store_set(user_id, platform, token_data):
     uid = str(user_id)
-    if uid not in data:
-        data[uid] = {}
-    data[uid][platform] = token_data
-    save_tokens(data)
+    with token_store.transact():
+        user_tokens = token_store.get(uid, {})
+        user_tokens[platform] = token_data
+        token_store.set(uid, user_tokens)
+    return user_tokens
 
-def remove_user_token(user_id, platform):
-    data = load_tokens()
+def _store_remove(user_id, platform):
     uid = str(user_id)
-    if uid in data and platform in data[uid]:
-        del data[uid][platform]
-        save_tokens(data)
+    with token_store.transact():
+        user_tokens = token_store.get(uid, {})
+        if platform in user_tokens:
+            del user_tokens[platform]
+            token_store.set(uid, user_tokens)
+    return user_tokens
+
+# Store access runs in a thread so SQLite I/O never blocks the event loop
+async def get_user_tokens(user_id):
+    if REDIS_URL:
+        return await asyncio.to_thread(token_store.get, str(user_id), {})
+    if user_id not in _TOKEN_CACHE:
+        _TOKEN_CACHE[user_id] = await asyncio.to_thread(token_store.get, str(user_id), {})
+    return _TOKEN_CACHE[user_id]
+
+async def set_user_token(user_id, platform, token_data):
+    user_tokens = await asyncio.to_thread(_store_set, user_id, platform, token_data)
+    if not REDIS_URL:
+        _TOKEN_CACHE[user_id] = user_tokens
+
+async def remove_user_token(user_id, platform):
+    user_tokens = await asyncio.to_thread(_store_remove, user_id, platform)
+    if not REDIS_URL:
+        _TOKEN_CACHE[user_id] = user_tokens
+
+# --- Thread pools ---
+# Platform SDKs are blocking; bounded pools keep their thread count predictable
+UPLOAD_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=UPLOAD_WORKERS, thread_name_prefix="uploader")
+AUTH_POOL = concurrent.futures.ThreadPoolExecutor(max_workers=4, thread_name_prefix="auth")
+
+async def run_in_pool(pool, func, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(pool, functools.partial(func, *args, **kwargs))
 
 # --- Platform imports ---
 from platforms.youtube_uploader import YouTubeUploader
@@ -81,6 +154,19 @@ PLATFORMS = {
     "tiktok": {"name": "TikTok", "emoji": "🎵", "uploader": tiktok},
 }
 
+PLATFORM_LABELS = {p_id: f"{p_info['emoji']} {p_info['name']}" for p_id, p_info in PLATFORMS.items()}
+
+def platforms_keyboard(platform_order, selected):
+    buttons = [
+        [InlineKeyboardButton(
+            text=("☑️ " if p_id in selected else "⬜ ") + PLATFORM_LABELS[p_id],
+            callback_data=f"toggle_{p_id}"
+        )]
+        for p_id in platform_order
+    ]
+    buttons.append([InlineKeyboardButton(text="🚀 Опубликовать", callback_data="publish")])
+    return InlineKeyboardMarkup(inline_keyboard=buttons)
+
 # --- FSM ---
 class UploadFlow(StatesGroup):
     waiting_video = State()
@@ -89,57 +175,98 @@ class UploadFlow(StatesGroup):
     choosing_platforms = State()
     uploading = State()
 
+# --- Outgoing rate limit ---
+# Stay under Telegram's ~30 msg/s global bot limit instead of hitting flood waits
+BOT_LIMIT = AsyncLimiter(28, 1)
+
+class RateLimitMiddleware(BaseRequestMiddleware):
+    async def __call__(self, make_request, bot, method):
+        if isinstance(method, GetUpdates):
+            return await make_request(bot, method)
+        async with BOT_LIMIT:
+            return await make_request(bot, method)
+
+# --- Downloads ---
+async def download_file(http, url, local_path):
+    # Stream straight to disk so a large video never sits in memory
+    async with http.get(url) as resp:
+        resp.raise_for_status()
+        async with aiofiles.open(local_path, "wb", buffering=DOWNLOAD_CHUNK_SIZE) as f:
+            async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                await f.write(chunk)
+
+# --- Publish queue ---
+@dataclass
+class UploadJob:
+    user_id: int
+    status_msg: Message
+    video_file_id: str
+    video_file_unique_id: str
+    video_file_size: int
+    title: str
+    description: str
+    selected: list
+    tokens: dict
+
+# Cached videos and in-flight .part downloads in use by a running job, protected from pruning
+_ACTIVE_VIDEOS = Counter()
+
 # --- Router ---
+# Resolves the sender's tokens once per update and passes them as `tokens`
+# to handlers registered with flags={"tokens": True}
+class TokensMiddleware(BaseMiddleware):
+    async def __call__(self, handler, event, data):
+        user = data.get("event_from_user")
+        if user and get_flag(data, "tokens"):
+            data["tokens"] = await get_user_tokens(user.id)
+        return await handler(event, data)
+
 router = Router()
+router.message.middleware(TokensMiddleware())
+router.callback_query.middleware(TokensMiddleware())
 
 # --- /start ---
-@router.message(CommandStart())
-async def cmd_start(message: Message):
-    tokens = get_user_tokens(message.from_user.id)
-    connected = []
-    for p_id, p_info in PLATFORMS.items():
-        if p_id in tokens:
-            connected.append(f"  {p_info['emoji']} {p_info['name']} ✅")
-        else:
-            connected.append(f"  {p_info['emoji']} {p_info['name']} ❌")
-
-    text = (
-        "🚀 <b>CrossyPosty</b> — кросспостинг видео\n\n"
-        "Отправь мне видео — я опубликую его на выбранных платформах.\n\n"
-        "<b>Подключённые аккаунты:</b>\n"
-        + "\n".join(connected) + "\n\n"
-        "<b>Команды:</b>\n"
-        "  /post — отправить видео\n"
-        "  /connect — подключить платформу\n"
-        "  /disconnect — отключить платформу\n"
-        "  /status — статус аккаунтов\n"
-        "  /help — помощь"
+_START_TEXT = (
+    "🚀 <b>CrossyPosty</b> — кросспостинг видео\n\n"
+    "Отправь мне видео — я опубликую его на выбранных платформах.\n\n"
+    "<b>Подключённые аккаунты:</b>\n"
+    "{connected}\n\n"
+    "<b>Команды:</b>\n"
+    "  /post — отправить видео\n"
+    "  /connect — подключить платформу\n"
+    "  /disconnect — отключить платформу\n"
+    "  /status — статус аккаунтов\n"
+    "  /help — помощь"
+)
+
+@router.message(CommandStart(), flags={"tokens": True})
+async def cmd_start(message: Message, tokens: dict):
+    connected = "\n".join(
+        f"  {label} {'✅' if p_id in tokens else '❌'}"
+        for p_id, label in PLATFORM_LABELS.items()
     )
-    await message.answer(text, parse_mode="HTML")
+    await message.answer(_START_TEXT.format(connected=connected), parse_mode="HTML")
 
 # --- /status ---
-@router.message(Command("status"))
-async def cmd_status(message: Message):
-    tokens = get_user_tokens(message.from_user.id)
+@router.message(Command("status"), flags={"tokens": True})
+async def cmd_status(message: Message, tokens: dict):
     lines = ["<b>📊 Статус аккаунтов:</b>\n"]
-    for p_id, p_info in PLATFORMS.items():
-        if p_id in tokens:
-            lines.append(f"{p_info['emoji']} {p_info['name']} — ✅ подключён")
-        else:
-            lines.append(f"{p_info['emoji']} {p_info['name']} — ❌ не подключён")
+    lines.extend(
+        f"{label} — ✅ подключён" if p_id in tokens else f"{label} — ❌ не подключён"
+        for p_id, label in PLATFORM_LABELS.items()
+    )
     await message.answer("\n".join(lines), parse_mode="HTML")
 
 # --- /connect ---
-@router.message(Command("connect"))
-async def cmd_connect(message: Message):
-    tokens = get_user_tokens(message.from_user.id)
-    buttons = []
-    for p_id, p_info in PLATFORMS.items():
-        status = "✅" if p_id in tokens else "❌"
-        buttons.append([InlineKeyboardButton(
-            text=f"{p_info['emoji']} {p_info['name']} {status}",
+@router.message(Command("connect"), flags={"tokens": True})
+async def cmd_connect(message: Message, tokens: dict):
+    buttons = [
+        [InlineKeyboardButton(
+            text=f"{label} {'✅' if p_id in tokens else '❌'}",
             callback_data=f"connect_{p_id}"
-        )])
+        )]
+        for p_id, label in PLATFORM_LABELS.items()
+    ]
     kb = InlineKeyboardMarkup(inline_keyboard=buttons)
     await message.answer("Выбери платформу для подключения:", reply_markup=kb)
 
@@ -225,16 +352,16 @@ async def connect_platform(callback: CallbackQuery, state: FSMContext):
     await callback.answer()
 
 # --- /disconnect ---
-@router.message(Command("disconnect"))
-async def cmd_disconnect(message: Message):
-    tokens = get_user_tokens(message.from_user.id)
-    buttons = []
-    for p_id, p_info in PLATFORMS.items():
-        if p_id in tokens:
-            buttons.append([InlineKeyboardButton(
-                text=f"❌ Отключить {p_info['emoji']} {p_info['name']}",
-                callback_data=f"disconnect_{p_id}"
-            )])
+@router.message(Command("disconnect"), flags={"tokens": True})
+async def cmd_disconnect(message: Message, tokens: dict):
+    buttons = [
+        [InlineKeyboardButton(
+            text=f"❌ Отключить {label}",
+            callback_data=f"disconnect_{p_id}"
+        )]
+        for p_id, label in PLATFORM_LABELS.items()
+        if p_id in tokens
+    ]
     if not buttons:
         await message.answer("Нет подключённых платформ.")
         return
@@ -244,7 +371,7 @@ async def cmd_disconnect(message: Message):
 @router.callback_query(F.data.startswith("disconnect_"))
 async def disconnect_platform(callback: CallbackQuery):
     platform = callback.data.replace("disconnect_", "")
-    remove_user_token(callback.from_user.id, platform)
+    await remove_user_token(callback.from_user.id, platform)
     name = PLATFORMS[platform]["name"]
     await callback.message.answer(f"✅ {name} отключён")
     await callback.answer()
@@ -256,6 +383,59 @@ async def cmd_post(message: Message, state: FSMContext):
     await message.answer("📹 Отправь мне видео для публикации:")
     await state.set_state(UploadFlow.waiting_video)
 
+# Auth replies, one handler per platform
+async def _handle_youtube_auth(user_id, text, message):
+    try:
+        creds = await run_in_pool(AUTH_POOL, youtube.exchange_code, text)
+        await set_user_token(user_id, "youtube", creds)
+        await message.answer("✅ YouTube подключён!")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {e}")
+
+async def _handle_vk_auth(user_id, text, message):
+    # Extract token from URL
+    if "access_token=" not in text:
+        await message.answer("❌ Отправь полную ссылку из адресной строки")
+        return
+    match = _VK_TOKEN_RE.search(text)
+    if match:
+        token = match.group(1)
+        await set_user_token(user_id, "vk", {"access_token": token})
+        await message.answer("✅ VK подключён!")
+    else:
+        await message.answer("❌ Не удалось извлечь токен из ссылки")
+
+async def _handle_instagram_auth(user_id, text, message):
+    parts = text.split(maxsplit=1)
+    if len(parts) != 2:
+        await message.answer("Отправь логин и пароль через пробел")
+        return
+    username, password = parts
+    try:
+        result = await run_in_pool(AUTH_POOL, instagram.login, username, password)
+        await set_user_token(user_id, "instagram", {
+            "username": username,
+            "session": result
+        })
+        await message.answer("✅ Instagram подключён!")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка входа: {e}")
+
+async def _handle_tiktok_auth(user_id, text, message):
+    try:
+        token_data = await run_in_pool(AUTH_POOL, tiktok.exchange_code, text)
+        await set_user_token(user_id, "tiktok", token_data)
+        await message.answer("✅ TikTok подключён!")
+    except Exception as e:
+        await message.answer(f"❌ Ошибка: {e}")
+
+AUTH_HANDLERS = {
+    "youtube": _handle_youtube_auth,
+    "vk": _handle_vk_auth,
+    "instagram": _handle_instagram_auth,
+    "tiktok": _handle_tiktok_auth,
+}
+
 # Handle incoming text (for auth codes and credentials)
 @router.message(UploadFlow.waiting_video, F.text)
 async def handle_auth_text(message: Message, state: FSMContext):
@@ -266,54 +446,9 @@ async def handle_auth_text(message: Message, state: FSMContext):
         await message.answer("Отправь видео или нажми /post")
         return
 
-    user_id = message.from_user.id
-    text = message.text.strip()
-
-    if connecting == "youtube":
-        try:
-            creds = await asyncio.to_thread(youtube.exchange_code, text)
-            set_user_token(user_id, "youtube", creds)
-            await message.answer("✅ YouTube подключён!")
-        except Exception as e:
-            await message.answer(f"❌ Ошибка: {e}")
-
-    elif connecting == "vk":
-        # Extract token from URL
-        if "access_token=" in text:
-            import re
-            match = re.search(r"access_token=([^&]+)", text)
-            if match:
-                token = match.group(1)
-                set_user_token(user_id, "vk", {"access_token": token})
-                await message.answer("✅ VK подключён!")
-            else:
-                await message.answer("❌ Не удалось извлечь токен из ссылки")
-        else:
-            await message.answer("❌ Отправь полную ссылку из адресной строки")
-
-    elif connecting == "instagram":
-        parts = text.split(maxsplit=1)
-        if len(parts) == 2:
-            username, password = parts
-            try:
-                result = await asyncio.to_thread(instagram.login, username, password)
-                set_user_token(user_id, "instagram", {
-                    "username": username,
-                    "session": result
-                })
-                await message.answer("✅ Instagram подключён!")
-            except Exception as e:
-                await message.answer(f"❌ Ошибка входа: {e}")
-        else:
-            await message.answer("Отправь логин и пароль через пробел")
-
-    elif connecting == "tiktok":
-        try:
-            token_data = await asyncio.to_thread(tiktok.exchange_code, text)
-            set_user_token(user_id, "tiktok", token_data)
-            await message.answer("✅ TikTok подключён!")
-        except Exception as e:
-            await message.answer(f"❌ Ошибка: {e}")
+    fn = AUTH_HANDLERS.get(connecting)
+    if fn:
+        await fn(message.from_user.id, message.text.strip(), message)
 
     await state.clear()
 
@@ -329,6 +464,7 @@ async def handle_video(message: Message, state: FSMContext):
 
     await state.update_data(
         video_file_id=video.file_id,
+        video_file_unique_id=video.file_unique_id,
         video_file_size=video.file_size,
     )
     await message.answer(
@@ -355,15 +491,14 @@ async def handle_title(message: Message, state: FSMContext):
     await state.set_state(UploadFlow.waiting_description)
 
 # Description
-@router.message(UploadFlow.waiting_description, F.text)
-async def handle_description(message: Message, state: FSMContext):
+@router.message(UploadFlow.waiting_description, F.text, flags={"tokens": True})
+async def handle_description(message: Message, state: FSMContext, tokens: dict):
     desc = message.text.strip()
     if desc == "-":
         desc = ""
     await state.update_data(description=desc)
 
     # Show platform selection
-    tokens = get_user_tokens(message.from_user.id)
     if not tokens:
         await message.answer(
             "❌ Нет подключённых платформ!\n"
@@ -372,20 +507,10 @@ async def handle_description(message: Message, state: FSMContext):
         await state.clear()
         return
 
-    buttons = []
     selected = list(tokens.keys())
-    await state.update_data(selected_platforms=selected)
+    await state.update_data(selected_platforms=selected, platform_order=list(selected))
 
-    for p_id in tokens:
-        p_info = PLATFORMS[p_id]
-        checked = "☑️" if p_id in selected else "⬜"
-        buttons.append([InlineKeyboardButton(
-            text=f"{checked} {p_info['emoji']} {p_info['name']}",
-            callback_data=f"toggle_{p_id}"
-        )])
-    buttons.append([InlineKeyboardButton(text="🚀 Опубликовать", callback_data="publish")])
-
-    kb = InlineKeyboardMarkup(inline_keyboard=buttons)
+    kb = platforms_keyboard(selected, selected)
     await message.answer("Выбери платформы:", reply_markup=kb)
     await state.set_state(UploadFlow.choosing_platforms)
 
@@ -402,23 +527,13 @@ async def toggle_platform(callback: CallbackQuery, state: FSMContext):
         selected.append(platform)
     await state.update_data(selected_platforms=selected)
 
-    tokens = get_user_tokens(callback.from_user.id)
-    buttons = []
-    for p_id in tokens:
-        p_info = PLATFORMS[p_id]
-        checked = "☑️" if p_id in selected else "⬜"
-        buttons.append([InlineKeyboardButton(
-            text=f"{checked} {p_info['emoji']} {p_info['name']}",
-            callback_data=f"toggle_{p_id}"
-        )])
-    buttons.append([InlineKeyboardButton(text="🚀 Опубликовать", callback_data="publish")])
-
-    await callback.message.edit_reply_markup(reply_markup=InlineKeyboardMarkup(inline_keyboard=buttons))
+    kb = platforms_keyboard(data.get("platform_order", []), selected)
+    await callback.message.edit_reply_markup(reply_markup=kb)
     await callback.answer()
 
 # Publish
-@router.callback_query(UploadFlow.choosing_platforms, F.data == "publish")
-async def publish(callback: CallbackQuery, state: FSMContext):
+@router.callback_query(UploadFlow.choosing_platforms, F.data == "publish", flags={"tokens": True})
+async def publish(callback: CallbackQuery, state: FSMContext, tokens: dict, upload_queue: asyncio.Queue):
     data = await state.get_data()
     selected = data.get("selected_platforms", [])
 
@@ -427,51 +542,212 @@ async def publish(callback: CallbackQuery, state: FSMContext):
         return
 
     await callback.message.edit_reply_markup(reply_markup=None)
-    status_msg = await callback.message.answer("⏳ Скачиваю видео...")
+    status_msg = await callback.message.answer("🕐 В очереди...")
 
-    bot_instance = callback.bot
     user_id = callback.from_user.id
-    tokens = get_user_tokens(user_id)
-    title = data.get("title", "Video")
-    description = data.get("description", "")
-    video_file_id = data["video_file_id"]
+    await upload_queue.put(UploadJob(
+        user_id=user_id,
+        status_msg=status_msg,
+        video_file_id=data["video_file_id"],
+        video_file_unique_id=data["video_file_unique_id"],
+        video_file_size=data["video_file_size"],
+        title=data.get("title", "Video"),
+        description=data.get("description", ""),
+        selected=selected,
+        tokens=tokens,
+    ))
+    await state.clear()
+    await callback.answer()
 
-    # Download video
-    file = await bot_instance.get_file(video_file_id)
-    local_path = str(DOWNLOAD_DIR / f"{uuid.uuid4().hex}.mp4")
-    await bot_instance.download_file(file.file_path, local_path)
+# --- Upload workers ---
+async def _upload_worker(queue, bot, http):
+    while True:
+        job = await queue.get()
+        try:
+            await process_upload(job, bot, http)
+        except Exception as e:
+            logger.exception(f"Publishing for user {job.user_id} failed")
+            try:
+                await job.status_msg.edit_text(f"❌ Ошибка публикации: {e}")
+            except Exception:
+                pass
+        finally:
+            queue.task_done()
+
+async def fetch_video(job, bot, http, local_path):
+    # Videos are cached by file_unique_id, so a re-publish skips the download
+    try:
+        st = await aiofiles.os.stat(local_path)
+        if st.st_size == job.video_file_size:
+            await asyncio.to_thread(os.utime, local_path)
+            logger.info(f"Video cache hit: {local_path}")
+            return
+    except FileNotFoundError:
+        pass
 
-    file_size_mb = os.path.getsize(local_path) / 1024 / 1024
+    # Download under a temporary name so concurrent jobs never see a partial file
+    tmp_path = str(DOWNLOAD_DIR / f"{uuid.uuid4().hex}.part")
+    _ACTIVE_VIDEOS[tmp_path] += 1
+    try:
+        # Resolved here, in the worker, so it stays off the user's path and is skipped on a cache hit
+        file = await bot.get_file(job.video_file_id)
+        await download_file(http, bot.session.api.file_url(bot.token, file.file_path), tmp_path)
+        await aiofiles.os.replace(tmp_path, local_path)
+    except BaseException:
+        try:
+            await aiofiles.os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+    finally:
+        del _ACTIVE_VIDEOS[tmp_path]
+
+    file_size_mb = (await aiofiles.os.stat(local_path)).st_size / 1024 / 1024
     logger.info(f"Video downloaded: {local_path} ({file_size_mb:.1f} MB)")
 
+def prune_download_cache():
+    # Drop unfinished downloads, then the least recently used videos once the
+    # cache exceeds its size limit
+    now = time.time()
+    entries = []
+    total = 0
+    for path in DOWNLOAD_DIR.iterdir():
+        if path.suffix not in (".mp4", ".part"):
+            continue
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        # A .part left behind by a download that never finished (crash, kill).
+        # With REDIS_URL other processes share downloads/, so only one untouched
+        # for longer than any download may take is known to be abandoned
+        if path.suffix == ".part" and str(path) not in _ACTIVE_VIDEOS and (
+            not REDIS_URL or now - st.st_mtime > DOWNLOAD_TIMEOUT
+        ):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            continue
+        total += st.st_size
+        if path.suffix == ".mp4":
+            entries.append((st.st_mtime, st.st_size, path))
+    if REDIS_URL:
+        # Videos aren't cached in this mode; each job removes its own file
+        return
+    for _, size, path in sorted(entries):
+        if total <= DOWNLOAD_CACHE_BYTES:
+            break
+        if str(path) in _ACTIVE_VIDEOS:
+            continue
+        try:
+            path.unlink()
+            total -= size
+        except FileNotFoundError:
+            pass
+
+async def process_upload(job, bot, http):
+    status_msg = job.status_msg
+    selected = job.selected
+    # Videos are cached by file_unique_id. With REDIS_URL, downloads/ is shared
+    # with other processes that can't see our active files, so each job gets
+    # its own file and removes it afterwards, as before the cache existed
+    name = uuid.uuid4().hex if REDIS_URL else job.video_file_unique_id
+    local_path = str(DOWNLOAD_DIR / f"{name}.mp4")
+    flush_task = None
+    _ACTIVE_VIDEOS[local_path] += 1
+    try:
+        await status_msg.edit_text("⏳ Скачиваю видео...")
+        await fetch_video(job, bot, http, local_path)
+        await status_msg.edit_text(f"⏳ Загружаю на {len(selected)} платформ...")
+
+        # Progress edits are coalesced: at most one per STATUS_EDIT_INTERVAL,
+        # with the latest text sent by a trailing edit when the window closes
+        loop = asyncio.get_running_loop()
+        last_edit = loop.time()
+        pending_text = None
+        done = 0
+
+        async def _edit(text):
+            nonlocal last_edit
+            last_edit = loop.time()
+            try:
+                await status_msg.edit_text(text)
+            except Exception:
+                logger.warning("Failed to update publish progress", exc_info=True)
+
+        async def _flush_later(delay):
+            nonlocal pending_text, flush_task
+            await asyncio.sleep(delay)
+            text, pending_text = pending_text, None
+            await _edit(text)
+            # Text pushed while the edit was in flight gets its own trailing edit
+            if pending_text is not None:
+                flush_task = asyncio.create_task(_flush_later(STATUS_EDIT_INTERVAL))
+            else:
+                flush_task = None
+
+        async def push(text):
+            nonlocal pending_text, flush_task
+            wait = STATUS_EDIT_INTERVAL - (loop.time() - last_edit)
+            if wait <= 0 and flush_task is None:
+                await _edit(text)
+                return
+            pending_text = text
+            if flush_task is None:
+                flush_task = asyncio.create_task(_flush_later(max(wait, 0)))
+
+        async def _upload_one(p_id):
+            nonlocal done
+            uploader = PLATFORMS[p_id]["uploader"]
+            try:
+                result = await run_in_pool(
+                    UPLOAD_POOL,
+                    uploader.upload,
+                    file_path=local_path,
+                    title=job.title,
+                    description=job.description,
+                    token_data=job.tokens.get(p_id, {})
+                )
+                outcome = p_id, True, result
+            except Exception as e:
+                logger.exception(f"Upload to {p_id} failed")
+                outcome = p_id, False, e
+            done += 1
+            if done < len(selected):
+                await push(f"⏳ Загружено {done} из {len(selected)} платформ...")
+            return outcome
+
+        # Uploads are independent network calls — run them concurrently
+        outcomes = await asyncio.gather(*[_upload_one(p_id) for p_id in selected], return_exceptions=True)
+    finally:
+        # Drop any pending progress edit so it can't overwrite the final report
+        if flush_task is not None:
+            flush_task.cancel()
+            await asyncio.gather(flush_task, return_exceptions=True)
+        _ACTIVE_VIDEOS[local_path] -= 1
+        if not _ACTIVE_VIDEOS[local_path]:
+            del _ACTIVE_VIDEOS[local_path]
+        if REDIS_URL:
+            try:
+                await aiofiles.os.remove(local_path)
+            except OSError:
+                pass
+        await asyncio.to_thread(prune_download_cache)
+
     results = []
     errors = []
 
-    for p_id in selected:
+    for p_id, outcome in zip(selected, outcomes):
         p_info = PLATFORMS[p_id]
-        p_tokens = tokens.get(p_id, {})
-
-        await status_msg.edit_text(f"⏳ Загружаю на {p_info['emoji']} {p_info['name']}...")
-
-        try:
-            uploader = p_info["uploader"]
-            result = await asyncio.to_thread(
-                uploader.upload,
-                file_path=local_path,
-                title=title,
-                description=description,
-                token_data=p_tokens
-            )
-            results.append(f"{p_info['emoji']} {p_info['name']}: ✅ {result.get('url', 'OK')}")
-        except Exception as e:
-            logger.exception(f"Upload to {p_id} failed")
-            errors.append(f"{p_info['emoji']} {p_info['name']}: ❌ {e}")
-
-    # Cleanup
-    try:
-        os.remove(local_path)
-    except:
-        pass
+        if isinstance(outcome, BaseException):
+            errors.append(f"{p_info['emoji']} {p_info['name']}: ❌ {outcome}")
+            continue
+        _, ok, payload = outcome
+        if ok:
+            results.append(f"{p_info['emoji']} {p_info['name']}: ✅ {payload.get('url', 'OK')}")
+        else:
+            errors.append(f"{p_info['emoji']} {p_info['name']}: ❌ {payload}")
 
     # Report
     lines = ["<b>📊 Результат публикации:</b>\n"]
@@ -482,31 +758,28 @@ async def publish(callback: CallbackQuery, state: FSMContext):
         lines.extend(errors)
 
     await status_msg.edit_text("\n".join(lines), parse_mode="HTML")
-    await state.clear()
 
 # --- /help ---
+_HELP_TEXT = (
+    "🚀 <b>CrossyPosty — помощь</b>\n\n"
+    "<b>Основные команды:</b>\n"
+    "  /post — отправить видео на публикацию\n"
+    "  /connect — подключить платформу\n"
+    "  /disconnect — отключить платформу\n"
+    "  /status — статус подключений\n\n"
+    "<b>Как пользоваться:</b>\n"
+    "1. Подключи аккаунты через /connect\n"
+    "2. Отправь видео или нажми /post\n"
+    "3. Введи заголовок и описание\n"
+    "4. Выбери платформы\n"
+    "5. Нажми Опубликовать\n\n"
+    "<b>Поддерживаемые платформы:</b>\n"
+    + "\n".join(f"  {label}" for label in PLATFORM_LABELS.values())
+)
+
 @router.message(Command("help"))
 async def cmd_help(message: Message):
-    await message.answer(
-        "🚀 <b>CrossyPosty — помощь</b>\n\n"
-        "<b>Основные команды:</b>\n"
-        "  /post — отправить видео на публикацию\n"
-        "  /connect — подключить платформу\n"
-        "  /disconnect — отключить платформу\n"
-        "  /status — статус подключений\n\n"
-        "<b>Как пользоваться:</b>\n"
-        "1. Подключи аккаунты через /connect\n"
-        "2. Отправь видео или нажми /post\n"
-        "3. Введи заголовок и описание\n"
-        "4. Выбери платформы\n"
-        "5. Нажми Опубликовать\n\n"
-        "<b>Поддерживаемые платформы:</b>\n"
-        "  ▶️ YouTube Shorts\n"
-        "  📱 VK Clips\n"
-        "  📸 Instagram Reels\n"
-        "  🎵 TikTok",
-        parse_mode="HTML"
-    )
+    await message.answer(_HELP_TEXT, parse_mode="HTML")
 
 # --- Main ---
 async def main():
@@ -514,8 +787,23 @@ async def main():
         print("[!] BOT_TOKEN not set in .env")
         sys.exit(1)
 
-    bot = Bot(token=BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    if not REDIS_URL:
+        await asyncio.to_thread(load_all_tokens)
+        logger.info(f"Loaded tokens for {len(_TOKEN_CACHE)} users")
+    await asyncio.to_thread(prune_download_cache)
+
+    # aiogram already reuses one pooled aiohttp session for all Bot API calls
+    session = AiohttpSession()
+    session.middleware(RateLimitMiddleware())
+    bot = Bot(token=BOT_TOKEN, session=session)
+    if REDIS_URL:
+        # Shared FSM across workers; abandoned flows expire after an hour.
+        # Tokens and downloads stay on local disk, so all workers must share one host
+        from aiogram.fsm.storage.redis import RedisStorage
+        storage = RedisStorage.from_url(REDIS_URL, state_ttl=3600, data_ttl=3600)
+    else:
+        storage = MemoryStorage()
+    dp = Dispatcher(storage=storage)
     dp.include_router(router)
 
     await bot.set_my_commands([
@@ -527,8 +815,37 @@ async def main():
         BotCommand(command="help", description="Help"),
     ])
 
+    # Shared across all downloads to keep connections to the file server warm
+    http = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=100, ttl_dns_cache=300, keepalive_timeout=75),
+        timeout=aiohttp.ClientTimeout(total=DOWNLOAD_TIMEOUT),
+    )
+
+    # Publishing runs in background workers so handlers return immediately
+    upload_queue = asyncio.Queue()
+    dp["upload_queue"] = upload_queue
+    workers = [
+        asyncio.create_task(_upload_worker(upload_queue, bot, http))
+        for _ in range(PUBLISH_WORKERS)
+    ]
+
     logger.info("CrossyPosty bot started!")
-    await dp.start_polling(bot)
+    try:
+        await dp.start_polling(bot)
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+        UPLOAD_POOL.shutdown(wait=False, cancel_futures=True)
+        AUTH_POOL.shutdown(wait=False, cancel_futures=True)
+        await http.close()
+        await bot.session.close()
+        await storage.close()
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    try:
+        import uvloop
+    except ImportError:
+        asyncio.run(main())
+    else:
+        uvloop.run(main())